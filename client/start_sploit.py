@@ -6,26 +6,43 @@ assert sys.version_info >= (3, 4), 'Python < 3.4 is not supported'
 
 import argparse
 import binascii
+import codecs
 import itertools
 import json
 import logging
 import os
 import random
 import re
+import selectors
+import signal
 import stat
 import subprocess
 import time
 import threading
+from collections import OrderedDict, deque
 from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
+from http.client import BadStatusLine, HTTPConnection, HTTPSConnection
 from math import ceil
-from urllib.parse import urljoin
-from urllib.request import Request, urlopen
+from urllib.error import HTTPError
+from urllib.parse import urljoin, urlsplit
+from urllib.request import Request, getproxies, proxy_bypass, urlopen
 
 
 os_windows = (os.name == 'nt')
 
 
+try:
+    # orjson is much faster on large flag batches, but we don't require it
+    from orjson import dumps as dump_json, loads as load_json
+except ImportError:
+    def dump_json(obj):
+        return json.dumps(obj).encode()
+
+    def load_json(data):
+        return json.loads(data.decode())
+
+
 HEADER = r'''
  ____            _                   _   _             _____
 |  _ \  ___  ___| |_ _ __ _   _  ___| |_(_)_   _____  |  ___|_ _ _ __ _ __ ___
@@ -59,12 +76,25 @@ BRIGHT_COLORS = [Style.FG_RED, Style.FG_GREEN, Style.FG_BLUE,
                  Style.FG_MAGENTA, Style.FG_CYAN]
 
 
+# Each thread uses its own random generator for colors, so the threads don't
+# contend for the global one (this matters for free-threaded Python builds)
+thread_local_random = threading.local()
+
+
+def get_random():
+    rand = getattr(thread_local_random, 'rand', None)
+    if rand is None:
+        rand = random.Random()
+        thread_local_random.rand = rand
+    return rand
+
+
 def highlight(text, style=None):
     if os_windows:
         return text
 
     if style is None:
-        style = [Style.BOLD, random.choice(BRIGHT_COLORS)]
+        style = [Style.BOLD, get_random().choice(BRIGHT_COLORS)]
     return '\033[{}m'.format(';'.join(str(item.value) for item in style)) + text + '\033[0m'
 
 
@@ -113,7 +143,7 @@ def parse_args():
 
 
 def fix_args(args):
-    check_sploit(args)
+    sploit_path = check_sploit(args)
 
     if '://' not in args.server_url:
         args.server_url = 'http://' + args.server_url
@@ -130,6 +160,8 @@ def fix_args(args):
         if not valid:
             raise ValueError('Wrong syntax for --distribute, use --distribute K/N (N >= 2, 1 <= K <= N)')
 
+    return sploit_path
+
 
 SCRIPT_EXTENSIONS = {
     '.pl': 'perl',
@@ -190,12 +222,13 @@ def check_sploit(args):
             else:
                 raise InvalidSploitError("The provided file doesn't appear to be executable")
 
+    return os.path.abspath(path)
+
 
 if os_windows:
     # By default, Ctrl+C does not work on Windows if we spawn subprocesses.
     # Here we fix that using WinApi. See https://stackoverflow.com/a/43095532
 
-    import signal
     import ctypes
     from ctypes import wintypes
 
@@ -237,15 +270,80 @@ class APIException(Exception):
 SERVER_TIMEOUT = 5
 
 
-def get_config(args):
-    req = Request(urljoin(args.server_url, '/api/get_config'))
+# Each thread talking to the server (the main thread and the posting loop)
+# keeps its own connection alive between requests
+server_connections = threading.local()
+
+
+def get_server_connection(args):
+    conn = getattr(server_connections, 'conn', None)
+    if conn is None:
+        url = urlsplit(args.server_url)
+        conn_class = HTTPSConnection if url.scheme == 'https' else HTTPConnection
+        conn = conn_class(url.netloc, timeout=SERVER_TIMEOUT)
+        server_connections.conn = conn
+    return conn
+
+
+def send_with_connection(args, method, path, body, headers):
+    conn = get_server_connection(args)
+    for attempt in range(2):
+        # The server may close a kept-alive connection at any moment,
+        # in this case we retry the request once using a new connection
+        can_retry = (attempt == 0 and conn.sock is not None)
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            return response.status, response.read()
+        except (BadStatusLine, ConnectionError):
+            conn.close()
+            if not can_retry:
+                raise
+        except Exception:
+            conn.close()
+            raise
+
+
+def send_with_urllib(method, url, body, headers):
+    req = Request(url, data=body, headers=headers, method=method)
+    try:
+        with urlopen(req, timeout=SERVER_TIMEOUT) as conn:
+            return conn.status, conn.read()
+    except HTTPError as e:
+        return e.code, e.read()
+
+
+def uses_proxy(url):
+    return url.scheme in getproxies() and not proxy_bypass(url.hostname)
+
+
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+
+
+def api_request(args, method, path, body=None):
+    headers = {}
+    if body is not None:
+        headers['Content-Type'] = 'application/json'
     if args.token is not None:
-        req.add_header('X-Token', args.token)
-    with urlopen(req, timeout=SERVER_TIMEOUT) as conn:
-        if conn.status != 200:
-            raise APIException(conn.read())
+        headers['X-Token'] = args.token
+    url = urljoin(args.server_url, path)
+
+    # http.client doesn't support proxies (set via the http_proxy/https_proxy environment
+    # variables) and redirects, so we fall back to urllib in these cases
+    if uses_proxy(urlsplit(url)):
+        status, content = send_with_urllib(method, url, body, headers)
+    else:
+        status, content = send_with_connection(args, method, urlsplit(url).path, body, headers)
+        if status in REDIRECT_STATUSES:
+            status, content = send_with_urllib(method, url, body, headers)
 
-        return json.loads(conn.read().decode())
+    if status != 200:
+        raise APIException(content)
+    return content
+
+
+def get_config(args):
+    return load_json(api_request(args, 'GET', '/api/get_config'))
 
 
 def post_flags(args, flags):
@@ -257,13 +355,7 @@ def post_flags(args, flags):
     data = [{'flag': item['flag'], 'sploit': sploit_name, 'team': item['team']}
             for item in flags]
 
-    req = Request(urljoin(args.server_url, '/api/post_flags'))
-    req.add_header('Content-Type', 'application/json')
-    if args.token is not None:
-        req.add_header('X-Token', args.token)
-    with urlopen(req, data=json.dumps(data).encode(), timeout=SERVER_TIMEOUT) as conn:
-        if conn.status != 200:
-            raise APIException(conn.read())
+    api_request(args, 'POST', '/api/post_flags', dump_json(data))
 
 
 exit_event = threading.Event()
@@ -271,43 +363,60 @@ exit_event = threading.Event()
 
 def once_in_a_period(period):
     for iter_no in itertools.count(1):
-        start_time = time.time()
+        # Use the monotonic clock, so system clock adjustments don't affect the period
+        start_time = time.monotonic()
         yield iter_no
 
-        time_spent = time.time() - start_time
+        time_spent = time.monotonic() - start_time
         if period > time_spent:
             exit_event.wait(period - time_spent)
         if exit_event.is_set():
             break
 
 
+# The forgotten flags are old enough to be already accepted by the server
+# (which ignores duplicates) or expired, so it is safe to post them again
+FLAGS_SEEN_LIMIT = 100000
+
+
 class FlagStorage:
     """
-    Thread-safe storage comprised of a set and a post queue.
+    Thread-safe storage comprised of a bounded set of seen flags and a post queue.
 
     Any number of threads may call add(), but only one "consumer thread"
     may call pick_flags() and mark_as_sent().
     """
 
     def __init__(self):
-        self._flags_seen = set()
-        self._queue = []
-        self._lock = threading.RLock()
+        # Flags are ordered by the time they were first seen, so we can forget the oldest ones
+        self._flags_seen = OrderedDict()
+        self._queue = deque()
+        self._lock = threading.Lock()
 
     def add(self, flags, team_name):
+        # Most of the flags are usually seen before, so we filter them out without
+        # taking the lock, and then re-check the remaining ones under the lock
+        new_flags = {item for item in flags if item not in self._flags_seen}
+        if not new_flags:
+            return
+
         with self._lock:
-            for item in flags:
-                if item not in self._flags_seen:
-                    self._flags_seen.add(item)
-                    self._queue.append({'flag': item, 'team': team_name})
+            new_flags = [item for item in new_flags if item not in self._flags_seen]
+            for item in new_flags:
+                self._flags_seen[item] = None
+            while len(self._flags_seen) > FLAGS_SEEN_LIMIT:
+                self._flags_seen.popitem(last=False)
 
-    def pick_flags(self):
+            self._queue.extend({'flag': item, 'team': team_name} for item in new_flags)
+
+    def pick_flags(self, limit):
         with self._lock:
-            return self._queue[:]
+            return list(itertools.islice(self._queue, limit))
 
     def mark_as_sent(self, count):
         with self._lock:
-            self._queue = self._queue[count:]
+            for _ in range(count):
+                self._queue.popleft()
 
     @property
     def queue_size(self):
@@ -319,29 +428,54 @@ flag_storage = FlagStorage()
 
 
 POST_PERIOD = 5
+# Limits the size of a single request, so a large queue (e.g. after the server
+# was unavailable for a while) is posted in several requests
+POST_FLAG_LIMIT = 10000
+
+
+def post_queued_flags(args):
+    # Post the whole queue, batch by batch
+    while not exit_event.is_set():
+        flags_to_post = flag_storage.pick_flags(POST_FLAG_LIMIT)
+        if not flags_to_post:
+            return
+
+        try:
+            post_flags(args, flags_to_post)
+
+            flag_storage.mark_as_sent(len(flags_to_post))
+            logging.info('{} flags posted to the server ({} in the queue)'.format(
+                len(flags_to_post), flag_storage.queue_size))
+        except Exception as e:
+            logging.error("Can't post flags to the server: {}".format(repr(e)))
+            logging.info("The flags will be posted next time")
+            return
+
+        if len(flags_to_post) < POST_FLAG_LIMIT:
+            return
 
 
 def run_post_loop(args):
     try:
         for _ in once_in_a_period(POST_PERIOD):
-            flags_to_post = flag_storage.pick_flags()
-
-            if flags_to_post:
-                try:
-                    post_flags(args, flags_to_post)
-
-                    flag_storage.mark_as_sent(len(flags_to_post))
-                    logging.info('{} flags posted to the server ({} in the queue)'.format(
-                        len(flags_to_post), flag_storage.queue_size))
-                except Exception as e:
-                    logging.error("Can't post flags to the server: {}".format(repr(e)))
-                    logging.info("The flags will be posted next time")
+            post_queued_flags(args)
     except Exception as e:
         logging.critical('Posting loop died: {}'.format(repr(e)))
         shutdown()
 
 
-display_output_lock = threading.RLock()
+display_output_lock = threading.Lock()
+
+# Each team keeps the same (randomly chosen) color of its output prefix
+team_prefixes = {}
+
+
+def get_team_prefix(team_name):
+    prefix = team_prefixes.get(team_name)
+    if prefix is None:
+        prefix = highlight(team_name + ': ')
+        team_prefixes[team_name] = prefix
+    return prefix
 
 
 def display_sploit_output(team_name, output_lines):
@@ -349,37 +483,145 @@ def display_sploit_output(team_name, output_lines):
         logging.info('{}: No output from the sploit'.format(team_name))
         return
 
-    prefix = highlight(team_name + ': ')
+    prefix = get_team_prefix(team_name)
     with display_output_lock:
         print('\n' + '\n'.join(prefix + line.rstrip() for line in output_lines) + '\n')
 
 
-def process_sploit_output(stream, args, team_name, flag_format, attack_no):
-    try:
-        output_lines = []
-        instance_flags = set()
+# When a sploit outputs a very long line and its output is not displayed, we search
+# the unfinished line for flags and keep only its end (long enough to contain a flag
+# split by the cut), so the memory and the time to process the line stay linear
+MAX_FLAG_LENGTH = 1024
+MAX_TAIL_LENGTH = 65536
+
+
+class SploitOutput:
+    """
+    Output of a sploit instance. The output is fed by chunks of arbitrary size,
+    flags are searched only in complete lines (so we don't miss a flag split
+    between two chunks).
+    """
+
+    def __init__(self, args, team_name, flag_format, attack_no):
+        self._args = args
+        self._team_name = team_name
+        self._flag_format = flag_format
+        self._attack_no = attack_no
+
+        # The output is only needed for the first attacks, where it is displayed
+        self._chunks = [] if attack_no <= args.verbose_attacks else None
+        # Decodes UTF-8 sequences split between chunks properly
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        # Pieces of the last unfinished line
+        self._tail = []
+        self._tail_length = 0
+        # Position to start the flag search from in the joined tail (non-zero if the tail
+        # was cut, so ^ doesn't match at the cut)
+        self._tail_start = 0
+        self._flags = set()
+
+    def feed(self, chunk):
+        try:
+            text = self._decoder.decode(chunk)
+
+            # Look for the line end only in the new text, so a long line
+            # doesn't make us rescan (and copy) its beginning again and again
+            pos = text.rfind('\n') + 1
+            if pos:
+                self._tail.append(text[:pos])
+                self._process(''.join(self._tail), self._tail_start)
+
+                text = text[pos:]
+                self._tail = []
+                self._tail_length = 0
+                self._tail_start = 0
+            if text:
+                self._tail.append(text)
+                self._tail_length += len(text)
+
+                if self._chunks is None and self._tail_length > MAX_TAIL_LENGTH:
+                    self._cut_tail()
+        except Exception as e:
+            logging.error('Failed to process sploit output: {}'.format(repr(e)))
+
+    def finish(self):
+        try:
+            self._tail.append(self._decoder.decode(b'', final=True))
+            self._process(''.join(self._tail), self._tail_start)
+            self._tail = []
+
+            if self._attack_no <= self._args.verbose_attacks and not exit_event.is_set():
+                # We don't want to spam the terminal on KeyboardInterrupt
+
+                output_lines = ''.join(self._chunks).splitlines()
+                display_sploit_output(self._team_name, output_lines)
+                if self._flags:
+                    logging.info('Got {} flags from "{}": {}'.format(
+                        len(self._flags), self._team_name, self._flags))
+        except Exception as e:
+            logging.error('Failed to process sploit output: {}'.format(repr(e)))
+
+    def _cut_tail(self):
+        tail = ''.join(self._tail)
+        self._search_flags(tail, self._tail_start)
 
+        # Keep one more character before the kept part, so ^ and lookbehinds see it
+        tail = tail[-(MAX_FLAG_LENGTH + 1):]
+        self._tail = [tail]
+        self._tail_length = len(tail)
+        self._tail_start = 1
+
+    def _process(self, data, start):
+        if not data:
+            return
+        if self._chunks is not None:
+            self._chunks.append(data)
+
+        self._search_flags(data, start)
+
+    def _search_flags(self, data, start):
+        chunk_flags = set(self._flag_format.findall(data, start))
+        if chunk_flags:
+            flag_storage.add(chunk_flags, self._team_name)
+            self._flags |= chunk_flags
+
+
+OUTPUT_CHUNK_SIZE = 65536
+
+
+def process_sploit_output(stream, output):
+    try:
         while True:
-            line = stream.readline()
-            if not line:
+            chunk = stream.read1(OUTPUT_CHUNK_SIZE)
+            if not chunk:
                 break
-            line = line.decode(errors='replace')
-            output_lines.append(line)
+            output.feed(chunk)
+    except Exception as e:
+        logging.error('Failed to read sploit output: {}'.format(repr(e)))
+    output.finish()
+
+
+# Outputs of all running sploit instances are read by a single thread (see run_reader_loop()).
+# On Windows, selectors don't support pipes, so we use a thread per instance there.
+output_selector = selectors.DefaultSelector()
 
-            line_flags = set(flag_format.findall(line))
-            if line_flags:
-                flag_storage.add(line_flags, team_name)
-                instance_flags |= line_flags
+READER_TIMEOUT = 0.1
 
-        if attack_no <= args.verbose_attacks and not exit_event.is_set():
-            # We don't want to spam the terminal on KeyboardInterrupt
 
-            display_sploit_output(team_name, output_lines)
-            if instance_flags:
-                logging.info('Got {} flags from "{}": {}'.format(
-                    len(instance_flags), team_name, instance_flags))
+def run_reader_loop():
+    try:
+        while not exit_event.is_set():
+            for key, _ in output_selector.select(timeout=READER_TIMEOUT):
+                chunk = os.read(key.fd, OUTPUT_CHUNK_SIZE)
+                if chunk:
+                    key.data.feed(chunk)
+                else:
+                    output_selector.unregister(key.fileobj)
+                    key.fileobj.close()
+                    key.data.finish()
     except Exception as e:
-        logging.error('Failed to process sploit output: {}'.format(repr(e)))
+        logging.critical('Output reading loop died: {}'.format(repr(e)))
+        shutdown()
 
 
 class InstanceStorage:
@@ -411,47 +653,73 @@ class InstanceStorage:
 
 
 instance_storage = InstanceStorage()
-instance_lock = threading.RLock()
+instance_lock = threading.Lock()
 
 
-def launch_sploit(args, team_name, team_addr, attack_no, flag_format):
+def get_sploit_command(args, sploit_path):
+    command = [sploit_path]
+    if args.interpreter is not None:
+        command = [args.interpreter] + command
+    return command
+
+
+def get_sploit_env():
     # For sploits written in Python, this env variable forces the interpreter to flush
     # stdout and stderr after each newline. Note that this is not default behavior
     # if the sploit's output is redirected to a pipe.
     env = os.environ.copy()
     env['PYTHONUNBUFFERED'] = '1'
+    return env
 
-    command = [os.path.abspath(args.sploit)]
-    if args.interpreter is not None:
-        command = [args.interpreter] + command
+
+def launch_sploit(args, command, env, team_name, team_addr, attack_no, flag_format):
     if team_addr is not None:
-        command.append(team_addr)
-    need_close_fds = (not os_windows)
+        command = command + [team_addr]
 
     if os_windows:
         # On Windows, we block Ctrl+C handling, spawn the process, and
         # then recover the handler. This is the only way to make Ctrl+C
         # intercepted by us instead of our child processes.
         kernel32.SetConsoleCtrlHandler(win_ignore_ctrl_c, True)
+    # Since Python 3.4, file descriptors are non-inheritable by default, so we don't need
+    # to close them in the child process (this takes a syscall per possible descriptor)
     proc = subprocess.Popen(command,
                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                            bufsize=1, close_fds=need_close_fds, env=env)
+                            bufsize=OUTPUT_CHUNK_SIZE, close_fds=False, env=env,
+                            start_new_session=True)
     if os_windows:
         kernel32.SetConsoleCtrlHandler(win_ignore_ctrl_c, False)
 
-    threading.Thread(target=lambda: process_sploit_output(
-        proc.stdout, args, team_name, flag_format, attack_no)).start()
+    output = SploitOutput(args, team_name, flag_format, attack_no)
+    if os_windows:
+        threading.Thread(target=process_sploit_output, args=(proc.stdout, output)).start()
+    else:
+        output_selector.register(proc.stdout, selectors.EVENT_READ, output)
 
     return proc, instance_storage.register_start(proc)
 
 
-def run_sploit(args, team_name, team_addr, attack_no, max_runtime, flag_format):
+def kill_sploit(proc):
+    if os_windows:
+        proc.kill()
+        return
+
+    # The sploit was started in a new session, so we can kill the processes
+    # it has spawned as well (otherwise they could live forever)
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        proc.kill()
+
+
+def run_sploit(args, command, env, team_name, team_addr, attack_no, max_runtime, flag_format):
     try:
         with instance_lock:
             if exit_event.is_set():
                 return
 
-            proc, instance_id = launch_sploit(args, team_name, team_addr, attack_no, flag_format)
+            proc, instance_id = launch_sploit(args, command, env, team_name, team_addr,
+                                              attack_no, flag_format)
     except Exception as e:
         if isinstance(e, FileNotFoundError):
             logging.error('Sploit file or the interpreter for it not found: {}'.format(repr(e)))
@@ -475,7 +743,7 @@ def run_sploit(args, team_name, team_addr, attack_no, max_runtime, flag_format):
 
         with instance_lock:
             if need_kill:
-                proc.kill()
+                kill_sploit(proc)
 
             instance_storage.register_stop(instance_id, need_kill)
     except Exception as e:
@@ -498,6 +766,25 @@ def show_time_limit_info(args, config, max_runtime, attack_no):
                 float(instance_storage.n_killed) / instance_storage.n_completed * 100))
 
 
+# The team list rarely changes, so we keep the last result of distribute_teams()
+# as a pair ((all teams, k, n), teams for this client)
+distributed_teams_cache = None
+
+
+def distribute_teams(teams, k, n):
+    global distributed_teams_cache
+
+    key = teams, k, n
+    if distributed_teams_cache is not None and distributed_teams_cache[0] == key:
+        return distributed_teams_cache[1]
+
+    crc32 = binascii.crc32
+    result = {name: addr for name, addr in teams.items()
+              if crc32(addr.encode()) % n == k - 1}
+    distributed_teams_cache = key, result
+    return result
+
+
 PRINTED_TEAM_NAMES = 5
 
 
@@ -506,9 +793,7 @@ def get_target_teams(args, teams, attack_no):
         return {'*': None}
 
     if args.distribute is not None:
-        k, n = args.distribute
-        teams = {name: addr for name, addr in teams.items()
-                 if binascii.crc32(addr.encode()) % n == k - 1}
+        teams = distribute_teams(teams, *args.distribute)
 
     if teams:
         if attack_no <= args.verbose_attacks:
@@ -523,9 +808,20 @@ def get_target_teams(args, teams, attack_no):
     return teams
 
 
+# Max time (in seconds) to spread the first wave of sploit launches of an attack over
+MAX_LAUNCH_SPREAD = 1
+
+
+# Stack size for the threads started after the posting and reading loops: the pool threads
+# (they only spawn sploit instances and wait for them) and, on Windows, the per-instance
+# output readers. They don't need the default stack size (8 MiB of reserved virtual memory
+# on Linux), which adds up for large --pool-size values.
+THREAD_STACK_SIZE = 512 * 1024
+
+
 def main(args):
     try:
-        fix_args(args)
+        sploit_path = fix_args(args)
     except (ValueError, InvalidSploitError) as e:
         logging.critical(str(e))
         return
@@ -533,14 +829,26 @@ def main(args):
     print(highlight(HEADER))
     logging.info('Connecting to the farm server at {}'.format(args.server_url))
 
-    threading.Thread(target=lambda: run_post_loop(args)).start()
+    threading.Thread(target=run_post_loop, args=(args,)).start()
+    if not os_windows:
+        threading.Thread(target=run_reader_loop).start()
+
+    command = get_sploit_command(args, sploit_path)
+    env = get_sploit_env()
+
+    try:
+        threading.stack_size(THREAD_STACK_SIZE)
+    except (ValueError, RuntimeError):
+        pass  # Keep the default stack size if the platform doesn't allow to change it
 
     config = flag_format = None
     pool = ThreadPoolExecutor(max_workers=args.pool_size)
     for attack_no in once_in_a_period(args.attack_period):
         try:
             config = get_config(args)
-            flag_format = re.compile(config['FLAG_FORMAT'])
+            # The sploit output is searched for flags by chunks of complete lines, MULTILINE
+            # makes ^ and $ match at the line boundaries as if the lines were searched one by one
+            flag_format = re.compile(config['FLAG_FORMAT'], re.MULTILINE)
         except Exception as e:
             logging.error("Can't get config from the server: {}".format(repr(e)))
             if attack_no == 1:
@@ -558,23 +866,59 @@ def main(args):
         max_runtime = args.attack_period / ceil(len(teams) / args.pool_size)
         show_time_limit_info(args, config, max_runtime, attack_no)
 
-        for team_name, team_addr in teams.items():
-            pool.submit(run_sploit, args, team_name, team_addr, attack_no, max_runtime, flag_format)
+        # Spawning of sploit instances is serialized by instance_lock, so we spread the first
+        # wave of launches instead of waking up all pool threads at once (later waves are
+        # spread naturally as the instances finish)
+        launch_interval = min(MAX_LAUNCH_SPREAD, max_runtime / 10) / args.pool_size
+        for i, (team_name, team_addr) in enumerate(teams.items()):
+            if 0 < i < args.pool_size and exit_event.wait(launch_interval):
+                break
+            pool.submit(run_sploit, args, command, env, team_name, team_addr,
+                        attack_no, max_runtime, flag_format)
 
 
 def shutdown():
     # Stop run_post_loop thread
     exit_event.set()
-    # Kill all child processes (so consume_sploit_ouput and run_sploit also will stop)
+    # Kill all child processes (so run_sploit and output readers also will stop)
     with instance_lock:
         for proc in instance_storage.instances.values():
-            proc.kill()
+            kill_sploit(proc)
+
+
+class TerminationSignal(Exception):
+    pass
+
+
+def ignore_termination_signals():
+    # shutdown() is the only way to kill the sploits (they are run in their own sessions),
+    # so a repeated signal must not interrupt it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if not os_windows:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+
+def raise_termination_signal(signum, frame):
+    ignore_termination_signals()
+    # We don't call shutdown() right here, since the main thread may hold instance_lock
+    raise TerminationSignal(signum)
 
 
 if __name__ == '__main__':
+    if not os_windows:
+        # Sploits are run in their own sessions, so they don't get SIGHUP when the terminal
+        # is closed. We kill them in shutdown() when we are terminated or hung up.
+        signal.signal(signal.SIGTERM, raise_termination_signal)
+        signal.signal(signal.SIGHUP, raise_termination_signal)
+
     try:
         main(parse_args())
     except KeyboardInterrupt:
+        ignore_termination_signals()
         logging.info('Got Ctrl+C, shutting down')
+    except TerminationSignal as e:
+        logging.info('Got signal {}, shutting down'.format(e))
     finally:
+        ignore_termination_signals()
         shutdown()